@@ -22,23 +22,36 @@
 :synopsis: ``watchmedo`` shell script utility.
 """
 
-import errno
+import importlib
+import json
 import os
 import os.path
+import signal
+import stat
 import sys
-import yaml
+import tempfile
 import time
+import yaml
 import logging
-from io import StringIO
 
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 from watchdog.version import VERSION_STRING
 from watchdog.utils import WatchdogShutdown, load_class
 
+try:
+    # Use the libyaml-based C loader and dumper when PyYAML was built with it.
+    from yaml import CSafeDumper as SafeDumper, CSafeLoader as SafeLoader
+except ImportError:  # pragma: no cover
+    from yaml import SafeDumper, SafeLoader
+
 logging.basicConfig(level=logging.INFO)
 
 CONFIG_KEY_TRICKS = 'tricks'
 CONFIG_KEY_PYTHON_PATH = 'python-path'
+CONFIG_CACHE_SUFFIX = '.cache'
+
+# Signals gracefully stopping ``auto_restart``.
+_TERMINATION_SIGNALS = frozenset({signal.SIGTERM, signal.SIGINT})
 
 epilog = """Copyright 2011 Yesudeep Mangalapilly <yesudeep@gmail.com>.
 Copyright 2012 Google, Inc & contributors.
@@ -53,6 +66,18 @@ cli.add_argument('--version',
 subparsers = cli.add_subparsers(dest="command")
 
 
+# Observer classes forced by the ``--debug-force-*`` options, in order of
+# precedence.
+_OBSERVER_TABLE = (
+    ('debug_force_polling', ('watchdog.observers.polling', 'PollingObserver')),
+    ('debug_force_kqueue', ('watchdog.observers.kqueue', 'KqueueObserver')),
+    ('debug_force_winapi_async', ('watchdog.observers.read_directory_changes_async', 'WindowsApiAsyncObserver')),
+    ('debug_force_winapi', ('watchdog.observers.read_directory_changes', 'WindowsApiObserver')),
+    ('debug_force_inotify', ('watchdog.observers.inotify', 'InotifyObserver')),
+    ('debug_force_fsevents', ('watchdog.observers.fsevents', 'FSEventsObserver')),
+)
+
+
 def argument(*name_or_flags, **kwargs):
     """Convenience function to properly format arguments to pass to the
       command decorator.
@@ -60,6 +85,14 @@ def argument(*name_or_flags, **kwargs):
     return (list(name_or_flags), kwargs)
 
 
+# Commands registered by the ``command`` decorator, their parsers are only
+# built when needed (see ``_add_command_parsers``).
+_commands = {}
+_command_aliases = {}
+# Parsers of the commands built so far, by command name.
+_command_parsers = {}
+
+
 def command(args=[], parent=subparsers, cmd_aliases=[]):
     """Decorator to define a new command in a sanity-preserving way.
       The function will be stored in the ``func`` variable when the parser
@@ -68,11 +101,35 @@ def command(args=[], parent=subparsers, cmd_aliases=[]):
           args.func(args)
     """
     def decorator(func):
-        parser = parent.add_parser(func.__name__, description=func.__doc__, aliases=cmd_aliases)
+        _commands[func.__name__] = (func, args, parent, cmd_aliases)
+        for name in [func.__name__] + cmd_aliases:
+            _command_aliases[name] = func.__name__
+        return func
+    return decorator
+
+
+def _add_command_parsers(name=None):
+    """
+    Builds the argument parsers of registered commands, once.
+
+    :param name:
+        The name or alias of the only command to build, or ``None`` to build
+        all of them. Unknown names also build all of them so that the help
+        lists every available command.
+    """
+    names = list(_commands)
+    if name in _command_aliases:
+        names = [_command_aliases[name]]
+
+    for cmd_name in names:
+        if cmd_name in _command_parsers:
+            continue
+        func, args, parent, cmd_aliases = _commands[cmd_name]
+        parser = parent.add_parser(cmd_name, description=func.__doc__, aliases=cmd_aliases)
         for arg in args:
             parser.add_argument(*arg[0], **arg[1])
-            parser.set_defaults(func=func)
-    return decorator
+        parser.set_defaults(func=func)
+        _command_parsers[cmd_name] = parser
 
 
 def path_split(pathname_spec, separator=os.pathsep):
@@ -97,35 +154,184 @@ def add_to_sys_path(pathnames, index=0):
         (Default 0) The index in the sys.path list where the paths will be
         added.
     """
-    for pathname in pathnames[::-1]:
-        sys.path.insert(index, pathname)
+    sys.path[index:index] = pathnames
+
+
+def _read_config_cache(cache_pathname, stat_result):
+    """
+    Returns the configuration stored in the cache file if it was built from
+    a tricks file with the given stat result, ``None`` otherwise.
+    """
+    try:
+        with open(cache_pathname, 'rb') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cache, dict):
+        return None
+    if (cache.get('mtime') != stat_result.st_mtime_ns
+            or cache.get('size') != stat_result.st_size):
+        return None
+    return cache.get('config')
+
+
+def _write_config_cache(cache_pathname, stat_result, config):
+    """
+    Atomically writes the configuration to the cache file, with the same
+    permissions as the tricks file. Configurations that do not survive a
+    JSON round-trip unchanged are not cached.
+    """
+    try:
+        data = json.dumps({
+            'mtime': stat_result.st_mtime_ns,
+            'size': stat_result.st_size,
+            'config': config,
+        })
+    except (TypeError, ValueError):
+        return
+    if json.loads(data)['config'] != config:
+        return
+
+    cache_dir = os.path.dirname(cache_pathname) or os.curdir
+    try:
+        fd, tmp_pathname = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    except OSError:
+        # Read-only directory or similar, caching is best-effort.
+        return
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        # mkstemp() creates the file with 0600 permissions.
+        os.chmod(tmp_pathname, stat.S_IMODE(stat_result.st_mode))
+        os.replace(tmp_pathname, cache_pathname)
+    except OSError:
+        try:
+            os.remove(tmp_pathname)
+        except OSError:
+            pass
 
 
 def load_config(tricks_file_pathname):
     """
     Loads the YAML configuration from the specified file.
 
+    The parsed configuration is cached next to the tricks file (with the
+    ``.cache`` suffix) and reused as long as the tricks file is unchanged.
+
     :param tricks_file_path:
         The path to the tricks configuration file.
     :returns:
         A dictionary of configuration information.
     """
+    stat_result = os.stat(tricks_file_pathname)
+    cache_pathname = tricks_file_pathname + CONFIG_CACHE_SUFFIX
+    config = _read_config_cache(cache_pathname, stat_result)
+    if config is not None:
+        return config
+
     with open(tricks_file_pathname, 'rb') as f:
-        return yaml.safe_load(f.read())
+        config = yaml.load(f, Loader=SafeLoader)
+    _write_config_cache(cache_pathname, stat_result, config)
+    return config
 
 
 def parse_patterns(patterns_spec, ignore_patterns_spec, separator=';'):
     """
     Parses pattern argument specs and returns a two-tuple of
-    (patterns, ignore_patterns).
+    (patterns, ignore_patterns). Empty patterns are dropped.
     """
-    patterns = patterns_spec.split(separator)
-    ignore_patterns = ignore_patterns_spec.split(separator)
-    if ignore_patterns == ['']:
-        ignore_patterns = []
+    patterns = tuple(p for p in patterns_spec.split(separator) if p)
+    ignore_patterns = tuple(p for p in ignore_patterns_spec.split(separator) if p)
     return (patterns, ignore_patterns)
 
 
+def _parse_signal(signal_spec):
+    """
+    Parses a signal argument spec, either a signal name (e.g. ``SIGINT``) or
+    a signal number, and returns the signal number.
+    """
+    if signal_spec.startswith("SIG"):
+        try:
+            return signal.Signals[signal_spec]
+        except KeyError:
+            raise ArgumentTypeError('unknown signal name: %s' % signal_spec)
+    try:
+        # Not all valid signal numbers are members of signal.Signals
+        # (e.g. real-time signals on Linux).
+        return int(signal_spec)
+    except ValueError:
+        raise ArgumentTypeError('invalid signal: %s' % signal_spec)
+
+
+def _unique_pathnames(pathnames):
+    """
+    Returns the given pathnames without the ones pointing to an already
+    listed location (e.g. ``foo``, ``./foo`` and ``foo/``). The first
+    spelling of each location is kept so that event paths are reported the
+    way the user wrote them.
+
+    :param pathnames:
+        A list of pathnames.
+    """
+    seen = set()
+    unique = []
+    for pathname in pathnames:
+        real_pathname = os.path.realpath(pathname)
+        if real_pathname not in seen:
+            seen.add(real_pathname)
+            unique.append(pathname)
+    return unique
+
+
+def _wait_for_shutdown():
+    """
+    Blocks until the calling thread is interrupted by an exception, such as
+    the ``WatchdogShutdown`` raised by the termination signal handlers.
+    """
+    while True:
+        if hasattr(signal, 'pause'):
+            # Sleeps until a signal is received, without periodic wakeups.
+            signal.pause()
+        else:
+            # Windows lacks signal.pause(), and a blocking wait cannot be
+            # interrupted by Ctrl+C there.
+            time.sleep(1)
+
+
+def _install_termination_handlers():
+    """
+    Handles termination signals by raising a semantic exception which will
+    allow us to gracefully unwind and stop the observers.
+    """
+    def handler_termination_signal(_signum, _frame):
+        # Neuter all signals so that we don't attempt a double shutdown
+        for signum in _TERMINATION_SIGNALS:
+            signal.signal(signum, signal.SIG_IGN)
+        raise WatchdogShutdown
+
+    for signum in _TERMINATION_SIGNALS:
+        signal.signal(signum, handler_termination_signal)
+
+
+def _select_observer(args):
+    """
+    Returns the observer class forced by the command line options, or the
+    most appropriate one for the platform if none is forced. Only the
+    module of the selected observer is imported.
+
+    :param args:
+        Command line argument options.
+    """
+    for flag, (module_name, class_name) in _OBSERVER_TABLE:
+        if getattr(args, flag, False):
+            return getattr(importlib.import_module(module_name), class_name)
+
+    # Automatically picks the most appropriate observer for the platform
+    # on which it is running.
+    from watchdog.observers import Observer
+    return Observer
+
+
 def observe_with(observer, event_handler, pathnames, recursive):
     """
     Single observer thread with a scheduled path and event handler.
@@ -139,14 +345,14 @@ def observe_with(observer, event_handler, pathnames, recursive):
     :param recursive:
         ``True`` if recursive; ``False`` otherwise.
     """
-    for pathname in set(pathnames):
+    for pathname in _unique_pathnames(pathnames):
         observer.schedule(event_handler, pathname, recursive)
     observer.start()
     try:
-        while True:
-            time.sleep(1)
+        _wait_for_shutdown()
     except WatchdogShutdown:
-        observer.stop()
+        pass
+    observer.stop()
     observer.join()
 
 
@@ -164,11 +370,18 @@ def schedule_tricks(observer, tricks, pathname, recursive):
     :param recursive:
         ``True`` if recursive; ``False`` otherwise.
     """
+    # Schedule tricks watching the same location under the same spelling so
+    # that the observer shares a single watch between them.
+    pathnames = {}
+    classes = {}
     for trick in tricks:
         for name, value in list(trick.items()):
-            TrickClass = load_class(name)
+            TrickClass = classes.get(name)
+            if TrickClass is None:
+                TrickClass = classes[name] = load_class(name)
             handler = TrickClass(**value)
             trick_pathname = getattr(handler, 'source_directory', None) or pathname
+            trick_pathname = pathnames.setdefault(os.path.realpath(trick_pathname), trick_pathname)
             observer.schedule(handler, trick_pathname, recursive)
 
 
@@ -212,35 +425,19 @@ def tricks_from(args):
     :param args:
         Command line argument options.
     """
-    if args.debug_force_polling:
-        from watchdog.observers.polling import PollingObserver as Observer
-    elif args.debug_force_kqueue:
-        from watchdog.observers.kqueue import KqueueObserver as Observer
-    elif args.debug_force_winapi_async:
-        from watchdog.observers.read_directory_changes_async import\
-            WindowsApiAsyncObserver as Observer
-    elif args.debug_force_winapi:
-        from watchdog.observers.read_directory_changes import\
-            WindowsApiObserver as Observer
-    elif args.debug_force_inotify:
-        from watchdog.observers.inotify import InotifyObserver as Observer
-    elif args.debug_force_fsevents:
-        from watchdog.observers.fsevents import FSEventsObserver as Observer
-    else:
-        # Automatically picks the most appropriate observer for the platform
-        # on which it is running.
-        from watchdog.observers import Observer
+    Observer = _select_observer(args)
 
     add_to_sys_path(path_split(args.python_path))
+    # Load every config before starting any observer: writing the cache of a
+    # tricks file must not trigger the tricks watching its directory.
+    # A missing file raises FileNotFoundError (an OSError with ENOENT).
+    configs = [(tricks_file, load_config(tricks_file)) for tricks_file in args.files]
+
+    _install_termination_handlers()
     observers = []
-    for tricks_file in args.files:
+    for tricks_file, config in configs:
         observer = Observer(timeout=args.timeout)
 
-        if not os.path.exists(tricks_file):
-            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), tricks_file)
-
-        config = load_config(tricks_file)
-
         try:
             tricks = config[CONFIG_KEY_TRICKS]
         except KeyError:
@@ -250,20 +447,18 @@ def tricks_from(args):
         if CONFIG_KEY_PYTHON_PATH in config:
             add_to_sys_path(config[CONFIG_KEY_PYTHON_PATH])
 
-        dir_path = os.path.dirname(tricks_file)
-        if not dir_path:
-            dir_path = os.path.relpath(os.getcwd())
+        dir_path = os.path.dirname(tricks_file) or os.curdir
         schedule_tricks(observer, tricks, dir_path, args.recursive)
         observer.start()
         observers.append(observer)
 
     try:
-        while True:
-            time.sleep(1)
+        _wait_for_shutdown()
     except WatchdogShutdown:
-        for o in observers:
-            o.unschedule_all()
-            o.stop()
+        pass
+    for o in observers:
+        o.unschedule_all()
+        o.stop()
     for o in observers:
         o.join()
 
@@ -294,27 +489,26 @@ def tricks_generate_yaml(args):
     """
     python_paths = path_split(args.python_path)
     add_to_sys_path(python_paths)
-    output = StringIO()
 
-    for trick_path in args.trick_paths:
-        TrickClass = load_class(trick_path)
-        output.write(TrickClass.generate_yaml())
+    if args.append_to_file is None:
+        with_header = not args.append_only
+    else:
+        with_header = not os.path.exists(args.append_to_file)
 
-    content = output.getvalue()
-    output.close()
+    parts = []
+    if with_header:
+        parts.append(yaml.dump({CONFIG_KEY_PYTHON_PATH: python_paths}, Dumper=SafeDumper))
+        parts.append("%s:\n" % CONFIG_KEY_TRICKS)
+    parts.extend(load_class(trick_path).generate_yaml()
+                 for trick_path in args.trick_paths)
+    content = ''.join(parts)
 
-    header = yaml.dump({CONFIG_KEY_PYTHON_PATH: python_paths})
-    header += "%s:\n" % CONFIG_KEY_TRICKS
     if args.append_to_file is None:
         # Output to standard output.
-        if not args.append_only:
-            content = header + content
         sys.stdout.write(content)
     else:
-        if not os.path.exists(args.append_to_file):
-            content = header + content
         with open(args.append_to_file, 'ab') as output:
-            output.write(content)
+            output.write(content.encode('utf-8'))
 
 
 @command([argument('directories',
@@ -390,25 +584,9 @@ def log(args):
     handler = LoggerTrick(patterns=patterns,
                           ignore_patterns=ignore_patterns,
                           ignore_directories=args.ignore_directories)
-    if args.debug_force_polling:
-        from watchdog.observers.polling import PollingObserver as Observer
-    elif args.debug_force_kqueue:
-        from watchdog.observers.kqueue import KqueueObserver as Observer
-    elif args.debug_force_winapi_async:
-        from watchdog.observers.read_directory_changes_async import\
-            WindowsApiAsyncObserver as Observer
-    elif args.debug_force_winapi:
-        from watchdog.observers.read_directory_changes import\
-            WindowsApiObserver as Observer
-    elif args.debug_force_inotify:
-        from watchdog.observers.inotify import InotifyObserver as Observer
-    elif args.debug_force_fsevents:
-        from watchdog.observers.fsevents import FSEventsObserver as Observer
-    else:
-        # Automatically picks the most appropriate observer for the platform
-        # on which it is running.
-        from watchdog.observers import Observer
+    Observer = _select_observer(args)
     observer = Observer(timeout=args.timeout)
+    _install_termination_handlers()
     observe_with(observer, handler, args.directories, args.recursive)
 
 
@@ -494,10 +672,7 @@ def shell_command(args):
     if not args.command:
         args.command = None
 
-    if args.debug_force_polling:
-        from watchdog.observers.polling import PollingObserver as Observer
-    else:
-        from watchdog.observers import Observer
+    Observer = _select_observer(args)
 
     patterns, ignore_patterns = parse_patterns(args.patterns,
                                                args.ignore_patterns)
@@ -508,6 +683,7 @@ def shell_command(args):
                                 wait_for_process=args.wait_for_process,
                                 drop_during_process=args.drop_during_process)
     observer = Observer(timeout=args.timeout)
+    _install_termination_handlers()
     observe_with(observer, handler, args.directories, args.recursive)
 
 
@@ -561,6 +737,7 @@ def shell_command(args):
           argument('--signal',
                    dest='signal',
                    default='SIGINT',
+                   type=_parse_signal,
                    help='stop the subprocess with this signal (default SIGINT)'),
           argument('--debug-force-polling',
                    default=False,
@@ -579,35 +756,14 @@ def auto_restart(args):
         Command line argument options.
     """
 
-    if args.debug_force_polling:
-        from watchdog.observers.polling import PollingObserver as Observer
-    else:
-        from watchdog.observers import Observer
+    Observer = _select_observer(args)
 
     from watchdog.tricks import AutoRestartTrick
-    import signal
 
     if not args.directories:
         args.directories = ['.']
 
-    # Allow either signal name or number.
-    if args.signal.startswith("SIG"):
-        stop_signal = getattr(signal, args.signal)
-    else:
-        stop_signal = int(args.signal)
-
-    # Handle termination signals by raising a semantic exception which will
-    # allow us to gracefully unwind and stop the observer
-    termination_signals = {signal.SIGTERM, signal.SIGINT}
-
-    def handler_termination_signal(_signum, _frame):
-        # Neuter all signals so that we don't attempt a double shutdown
-        for signum in termination_signals:
-            signal.signal(signum, signal.SIG_IGN)
-        raise WatchdogShutdown
-
-    for signum in termination_signals:
-        signal.signal(signum, handler_termination_signal)
+    _install_termination_handlers()
 
     patterns, ignore_patterns = parse_patterns(args.patterns,
                                                args.ignore_patterns)
@@ -617,7 +773,7 @@ def auto_restart(args):
                                patterns=patterns,
                                ignore_patterns=ignore_patterns,
                                ignore_directories=args.ignore_directories,
-                               stop_signal=stop_signal,
+                               stop_signal=args.signal,
                                kill_after=args.kill_after)
     handler.start()
     observer = Observer(timeout=args.timeout)
@@ -631,6 +787,8 @@ def auto_restart(args):
 
 def main():
     """Entry-point function."""
+    # Only build the parser of the invoked command.
+    _add_command_parsers(sys.argv[1] if len(sys.argv) > 1 else None)
     args = cli.parse_args()
     if args.command is None:
         cli.print_help()
@@ -8,6 +8,7 @@ import pytest
 yaml = pytest.importorskip('yaml')  # noqa
 
 import os  # noqa
+import stat  # noqa
 
 from watchdog import watchmedo  # noqa
 from yaml.constructor import ConstructorError  # noqa
@@ -71,3 +72,298 @@ def test_kill_auto_restart(tmpdir, capfd):
     assert '+++++ 9' not in cap.out     # we killed the subprocess before the end
     # in windows we seem to lose the subprocess stderr
     # assert 'KeyboardInterrupt' in cap.err
+
+
+def test_load_config_cache(tmpdir, monkeypatch):
+    """Verifies the parsed config is cached and invalidated on change"""
+
+    yaml_file = os.path.join(tmpdir, 'config_file.yaml')
+    cache_file = yaml_file + watchmedo.CONFIG_CACHE_SUFFIX
+    with open(yaml_file, 'w') as f:
+        f.write('one: value\n')
+    os.chmod(yaml_file, 0o640)
+
+    assert watchmedo.load_config(yaml_file) == {'one': 'value'}
+    assert os.path.exists(cache_file)
+    if os.name == 'posix':
+        assert stat.S_IMODE(os.stat(cache_file).st_mode) == 0o640
+
+    def load(*args, **kwargs):
+        raise AssertionError('the YAML file should not be parsed again')
+
+    with monkeypatch.context() as m:
+        m.setattr(watchmedo.yaml, 'load', load)
+        assert watchmedo.load_config(yaml_file) == {'one': 'value'}
+
+    with open(yaml_file, 'w') as f:
+        f.write('one: other value\n')
+
+    assert watchmedo.load_config(yaml_file) == {'one': 'other value'}
+
+
+def test_load_config_cache_mtime(tmpdir):
+    """Verifies the cache is invalidated when only the mtime changes"""
+
+    yaml_file = os.path.join(tmpdir, 'config_file.yaml')
+    with open(yaml_file, 'w') as f:
+        f.write('one: value\n')
+    st = os.stat(yaml_file)
+
+    assert watchmedo.load_config(yaml_file) == {'one': 'value'}
+
+    with open(yaml_file, 'w') as f:
+        f.write('one: VALUE\n')
+    os.utime(yaml_file, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert os.stat(yaml_file).st_size == st.st_size
+
+    assert watchmedo.load_config(yaml_file) == {'one': 'VALUE'}
+
+
+def test_load_config_cache_not_json(tmpdir):
+    """Verifies configs that JSON cannot represent faithfully are not cached"""
+
+    yaml_file = os.path.join(tmpdir, 'config_file.yaml')
+    with open(yaml_file, 'w') as f:
+        f.write('1: one\n')
+
+    assert watchmedo.load_config(yaml_file) == {1: 'one'}
+    assert not os.path.exists(yaml_file + watchmedo.CONFIG_CACHE_SUFFIX)
+
+
+def test_add_command_parsers_alias():
+    """Verifies a command parser can be built from one of its aliases"""
+
+    watchmedo._add_command_parsers('tricks')
+    args = watchmedo.cli.parse_args(['tricks', 'tricks.yaml'])
+    assert args.func is watchmedo.tricks_from
+    assert args.files == ['tricks.yaml']
+
+    # Building again, or building every parser, keeps the existing one.
+    parser = watchmedo._command_parsers['tricks_from']
+    watchmedo._add_command_parsers('tricks_from')
+    watchmedo._add_command_parsers()
+    assert watchmedo._command_parsers['tricks_from'] is parser
+    assert set(watchmedo._command_parsers) == set(watchmedo._commands)
+
+
+@pytest.mark.skipif(os.name != 'posix', reason='POSIX signals only')
+@pytest.mark.parametrize('signum', ['SIGINT', 'SIGTERM'])
+def test_log_termination_signal(tmpdir, signum):
+    """Verifies the log command stops cleanly on a termination signal"""
+    import signal
+    import subprocess
+    import sys
+    import threading
+    import time
+
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'watchdog.watchmedo', 'log', str(tmpdir)],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    output = []
+    reader = threading.Thread(target=lambda: output.extend(proc.stdout))
+    reader.start()
+    try:
+        # Wait for the first logged event: the observer is running and the
+        # signal handlers are installed.
+        for i in range(50):
+            open(os.path.join(tmpdir, 'file-%d' % i), 'w').close()
+            time.sleep(0.2)
+            if any('on_created' in line for line in output):
+                break
+        else:
+            pytest.fail('no event logged: %s' % ''.join(output))
+
+        proc.send_signal(getattr(signal, signum))
+        assert proc.wait(timeout=10) == 0
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        reader.join()
+        proc.stdout.close()
+    assert 'Traceback' not in ''.join(output)
+
+
+def test_unique_pathnames(tmpdir):
+    """Verifies aliases of the same location are only kept once"""
+
+    foo = os.path.join(tmpdir, 'foo')
+    bar = os.path.join(tmpdir, 'bar')
+    os.mkdir(foo)
+    os.mkdir(bar)
+
+    pathnames = [foo, os.path.join(foo, ''), os.path.join(tmpdir, '.', 'foo'), bar, foo]
+    assert watchmedo._unique_pathnames(pathnames) == [foo, bar]
+
+
+def test_schedule_tricks_unique_source_directories(tmpdir, monkeypatch):
+    """Verifies tricks watching aliases of one directory share its spelling"""
+    from watchdog.tricks import Trick
+
+    class SourceTrick(Trick):
+        def __init__(self, source_directory):
+            super().__init__()
+            self.source_directory = source_directory
+
+    class DummyObserver:
+        def __init__(self):
+            self.scheduled = []
+
+        def schedule(self, event_handler, path, recursive=False):
+            self.scheduled.append(path)
+
+    monkeypatch.chdir(tmpdir)
+    os.mkdir('foo')
+    os.mkdir('bar')
+    monkeypatch.setattr(watchmedo, 'load_class', lambda name: SourceTrick)
+    observer = DummyObserver()
+    tricks = [{'SourceTrick': {'source_directory': 'foo'}},
+              {'SourceTrick': {'source_directory': './foo/'}},
+              {'SourceTrick': {'source_directory': 'bar'}}]
+    watchmedo.schedule_tricks(observer, tricks, '.', False)
+    assert observer.scheduled == ['foo', 'foo', 'bar']
+
+
+def test_select_observer():
+    """Verifies the observer forced on the command line is picked"""
+    from argparse import Namespace
+    from watchdog.observers import Observer
+    from watchdog.observers.polling import PollingObserver
+
+    assert watchmedo._select_observer(Namespace(debug_force_polling=True)) is PollingObserver
+    assert watchmedo._select_observer(Namespace(debug_force_polling=False)) is Observer
+    assert watchmedo._select_observer(Namespace()) is Observer
+
+
+def test_parse_patterns():
+    """Verifies pattern specs are split into tuples without empty patterns"""
+
+    assert watchmedo.parse_patterns('*', '') == (('*',), ())
+    assert watchmedo.parse_patterns('*.py;*.txt;', ';*.pyc') == (('*.py', '*.txt'), ('*.pyc',))
+    assert watchmedo.parse_patterns('*.py|*.txt', '', separator='|') == (('*.py', '*.txt'), ())
+
+
+def test_tricks_generate_yaml(capsys):
+    """Verifies the generated tricks YAML can be loaded back"""
+    from argparse import Namespace
+
+    args = Namespace(trick_paths=['watchdog.tricks.LoggerTrick'], python_path='.',
+                     append_to_file=None, append_only=False)
+    watchmedo.tricks_generate_yaml(args)
+    config = yaml.safe_load(capsys.readouterr().out)
+    assert config[watchmedo.CONFIG_KEY_PYTHON_PATH] == ['.']
+    assert 'watchdog.tricks.LoggerTrick' in config[watchmedo.CONFIG_KEY_TRICKS][0]
+
+    args.append_only = True
+    watchmedo.tricks_generate_yaml(args)
+    assert capsys.readouterr().out.startswith('- watchdog.tricks.LoggerTrick:')
+
+
+def test_add_to_sys_path(monkeypatch):
+    """Verifies paths are inserted in order at the given index"""
+    import sys
+
+    monkeypatch.setattr(sys, 'path', ['first', 'last'])
+    watchmedo.add_to_sys_path(['a', 'b'], index=1)
+    assert sys.path == ['first', 'a', 'b', 'last']
+    watchmedo.add_to_sys_path(('c',))
+    assert sys.path == ['c', 'first', 'a', 'b', 'last']
+
+
+def test_schedule_tricks_loads_class_once(tmpdir, monkeypatch):
+    """Verifies a trick class used several times is only resolved once"""
+    from watchdog.tricks import LoggerTrick
+
+    calls = []
+
+    def load_class(name):
+        calls.append(name)
+        return LoggerTrick
+
+    class DummyObserver:
+        def __init__(self):
+            self.scheduled = []
+
+        def schedule(self, event_handler, path, recursive=False):
+            self.scheduled.append((event_handler, path))
+
+    monkeypatch.setattr(watchmedo, 'load_class', load_class)
+    observer = DummyObserver()
+    tricks = [{'watchdog.tricks.LoggerTrick': {}}, {'watchdog.tricks.LoggerTrick': {}}]
+    watchmedo.schedule_tricks(observer, tricks, str(tmpdir), False)
+    assert calls == ['watchdog.tricks.LoggerTrick']
+    assert len(observer.scheduled) == 2
+
+
+def test_load_config_missing_file(tmpdir):
+    """Verifies a missing tricks file raises an ENOENT OSError"""
+    import errno
+
+    yaml_file = os.path.join(tmpdir, 'missing.yaml')
+    with pytest.raises(OSError) as exc_info:
+        watchmedo.load_config(yaml_file)
+    assert exc_info.value.errno == errno.ENOENT
+    assert exc_info.value.filename == yaml_file
+
+
+def test_tricks_generate_yaml_append_to_file(tmpdir):
+    """Verifies the generated tricks YAML is appended to the given file"""
+    from argparse import Namespace
+
+    yaml_file = os.path.join(tmpdir, 'tricks.yaml')
+    args = Namespace(trick_paths=['watchdog.tricks.LoggerTrick'], python_path='.',
+                     append_to_file=yaml_file, append_only=False)
+    watchmedo.tricks_generate_yaml(args)
+    args.trick_paths = ['watchdog.tricks.ShellCommandTrick']
+    watchmedo.tricks_generate_yaml(args)
+
+    with open(yaml_file) as f:
+        config = yaml.safe_load(f)
+    assert config[watchmedo.CONFIG_KEY_PYTHON_PATH] == ['.']
+    tricks = config[watchmedo.CONFIG_KEY_TRICKS]
+    assert len(tricks) == 2
+    assert 'watchdog.tricks.LoggerTrick' in tricks[0]
+    assert 'watchdog.tricks.ShellCommandTrick' in tricks[1]
+
+
+@pytest.mark.parametrize('signal_spec, message', [
+    ('SIGFOO', 'unknown signal name: SIGFOO'),
+    ('abc', 'invalid signal: abc'),
+])
+def test_auto_restart_invalid_signal(capsys, signal_spec, message):
+    """Verifies an invalid signal is reported with the auto_restart usage"""
+
+    watchmedo._add_command_parsers('auto_restart')
+    with pytest.raises(SystemExit) as exc_info:
+        watchmedo.cli.parse_args(['auto_restart', '--signal', signal_spec, 'true'])
+    assert exc_info.value.code == 2
+    err = capsys.readouterr().err
+    assert err.startswith('usage: ') and ' auto_restart ' in err.splitlines()[0]
+    assert 'argument --signal: ' + message in err
+
+
+def test_auto_restart_signal():
+    """Verifies signal names and numbers are accepted"""
+    import signal
+
+    watchmedo._add_command_parsers('auto_restart')
+    args = watchmedo.cli.parse_args(['auto_restart', 'true'])
+    assert args.signal == signal.SIGINT
+    args = watchmedo.cli.parse_args(['auto_restart', '--signal', 'SIGTERM', 'true'])
+    assert args.signal == signal.SIGTERM
+    # Real-time signals on Linux have no signal.Signals member.
+    args = watchmedo.cli.parse_args(['auto_restart', '--signal', '40', 'true'])
+    assert args.signal == 40
+
+
+def test_tricks_generate_yaml_redirected_stdout():
+    """Verifies the generated tricks YAML can be written to any text stream"""
+    from argparse import Namespace
+    from contextlib import redirect_stdout
+    from io import StringIO
+
+    args = Namespace(trick_paths=['watchdog.tricks.LoggerTrick'], python_path='.',
+                     append_to_file=None, append_only=True)
+    output = StringIO()
+    with redirect_stdout(output):
+        watchmedo.tricks_generate_yaml(args)
+    assert output.getvalue().startswith('- watchdog.tricks.LoggerTrick:')